@@ -1,12 +1,24 @@
 """ Module for computing the significant locations using gps data """
-import math
-from sklearn.cluster import KMeans, DBSCAN
+import os
+import tempfile
+from collections import OrderedDict
+import compress_pickle as pickle
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from scipy.spatial import cKDTree
 import pandas as pd
 import numpy as np
 import LAMP
-from ..feature_types import primary_feature, log
+from ..feature_types import primary_feature, log, cache_finder
 from ..raw.gps import gps
+try:
+    from cuml.cluster import KMeans as cuKMeans
+except ImportError:
+    cuKMeans = None
 
+REDUCED_DATA_KEY = 'cortex.significant_locations.reduced'
+# Reduced gps data of the most recently used participants, keyed by LAMP id
+_REDUCED_DATA_CACHE = OrderedDict()
+_REDUCED_DATA_CACHE_SIZE = 128
 
 @primary_feature(
     name='cortex.significant_locations',
@@ -18,6 +30,7 @@ def significant_locations(k_max=10,
                           min_cluster_size=0.01,
                           max_dist=300,
                           method='mode',
+                          backend='sklearn',
                           attach=False,
                           **kwargs):
     """ Get the coordinates and proportional time of significant locations
@@ -25,11 +38,8 @@ def significant_locations(k_max=10,
 
 
     This method uses the the KMeans clustering method.
-    NOTE: Via DBSCan, this algorithm first reduces the amount of gps readings
-    used to generate significant locations. If there is a large amount of new
-    gps data to reduce, this step can take a long time
-    NOTE: DBScan uses O(n*k) memory. If you run it on a large GPS dataframe
-    (>100k points), a memory crash could occur
+    NOTE: By snapping points to a grid of side eps, this algorithm first
+    reduces the amount of gps readings used to generate significant locations.
 
     NOTE: This algorithm does NOT return the centroid radius and thus cannot
     be used to coalesce multiple SigLocs into one.
@@ -43,6 +53,8 @@ def significant_locations(k_max=10,
             a cluster for it to be significant.
         max_dist (int): The farthest distance, in m, that two points can be separated by.
         method (string): 'mode' or 'k_means'. Method for computing sig_locs.
+        backend (string): 'sklearn' or 'cuml'. The KMeans implementation used
+            with method='k_means'; 'cuml' runs on the GPU if cuML is installed.
         attach (boolean): Indicates whether to use LAMP.Type.attachments in calculating the feature.
         **kwargs:
             id (string): The participant's LAMP id. Required.
@@ -50,6 +62,8 @@ def significant_locations(k_max=10,
                 is being generated. Required.
             end (int): The last UNIX timestamp (in ms) of the window for which the feature
                 is being generated. Required.
+            cache (bool): Indicates whether to also keep the gps data reduced by
+                method='k_means' locally in the cache dir.
 
     Returns:
         A dict containing the fields:
@@ -64,50 +78,34 @@ def significant_locations(k_max=10,
             has_raw_data (int): Indicates whether there is raw data present.
     """
     if method == 'k_means':
-        return _significant_locations_kmeans(k_max, eps, **kwargs)
+        return _significant_locations_kmeans(k_max, eps, backend, **kwargs)
     return _significant_locations_mode(max_clusters, min_cluster_size, max_dist, **kwargs)
 
 def euclid(gps0, gps1):
     """ Calculates euclidean distance
 
         Args:
-            gps0, gps1 the two gps points in lattitude and longitude
+            gps0, gps1 the two gps points in lattitude and longitude; either
+                coordinate may also be an np.ndarray to compute many
+                distances at once
         Returns:
             The euclidean distance
 
         Calculates straight-line (not great-circle) distance between two GPS
-        points on Earth in kilometers; equivalent to roughly ~55% - 75% of the
-        Haversian (great-circle) distance. 110.25 is conversion metric marking
-        the length of a spherical degree.
+        points on Earth in kilometers; a close approximation of the Haversian
+        (great-circle) distance over short distances. 110.25 is conversion
+        metric marking the length of a spherical degree. Longitudes are scaled
+        by the cosine of the latitude of gps1 (converted to radians).
 
         Reference:
         https://jonisalonen.com/2014/computing-distance-between-coordinates-can-be-simple-and-fast/
     """
     def _euclid(lat, lng, lat0, lng0):  # degrees -> km
-        return 110.25 * ((((lat - lat0) ** 2) + (((lng - lng0) * np.cos(lat0)) ** 2)) ** 0.5)
+        cos_lat0 = np.cos(np.radians(lat0))
+        return 110.25 * np.sqrt((lat - lat0) ** 2 + ((lng - lng0) * cos_lat0) ** 2)
     return _euclid(gps0[0], gps0[1], gps1[0], gps1[1])
 
 
-def distance(cluster1, cluster2):
-    """ Function to find the distance
-
-        Args:
-            cluster1 (tuple): Geo coordinate
-            cluster2 (tuple) Geo Coordinate
-        Returns:
-            A float, the distance in meters.
-    """
-    R = 6378.137
-    d_lat = cluster2[0] * math.pi / 180 - cluster1[0] * math.pi / 180
-    d_lon = cluster2[1] * math.pi / 180 - cluster1[1] * math.pi / 180
-    val1 = math.sin(d_lat / 2) * math.sin(d_lat / 2)
-    val2 = math.cos(cluster1[0] * math.pi / 180) * math.cos(cluster2[0] * math.pi / 180)
-    val3 = math.sin(d_lon / 2) * math.sin(d_lon / 2)
-    val4 = val1 + (val2 * val3)
-    dist = 2 * math.atan2(math.sqrt(val4), math.sqrt(1 - val4))
-    dist_m = R * dist
-    return dist_m * 1000
-
 def remove_clusters(clusters, max_dist):
     """ Function to remove clusters that are less than specified distance
         (MAX_DIST) away from at least one other cluster
@@ -119,159 +117,283 @@ def remove_clusters(clusters, max_dist):
         Returns:
             A list, the same as clusters, with {'rank'} fields added.
     """
-    n = len(clusters)
-    for i in range(n - 1):
-        big_cluster_prop = clusters[i]['proportion']
-        if big_cluster_prop > 0:
-            big_cluster_latlon = (clusters[i]['latitude'], clusters[i]['longitude'])
-            for j in range(i + 1, n):
-                small_cluster_latlon = (clusters[j]['latitude'], clusters[j]['longitude'])
-                dist = distance(big_cluster_latlon, small_cluster_latlon)
-                if dist < max_dist:
-                    clusters[i]['proportion'] += clusters[j]['proportion']
-                    clusters[j]['proportion'] = 0
-                    clusters[i]['duration'] += clusters[j]['duration']
-    clusters = [cl for cl in clusters if cl['proportion'] > 0]
-    for i, cluster in enumerate(clusters):
-        cluster['rank'] = i
-    return clusters
-
-def _location_duration(df, cluster):
-    """ Helper function to get location duration
+    if len(clusters) == 0:
+        return clusters
+    lats = np.array([cl['latitude'] for cl in clusters], dtype=float)
+    lons = np.array([cl['longitude'] for cl in clusters], dtype=float)
+    props = np.array([cl['proportion'] for cl in clusters], dtype=float)
+    durations = np.array([cl['duration'] for cl in clusters], dtype=np.int64)
+
+    if max_dist > 0:
+        # Find the close pairs with a KD-tree over points on a sphere of Earth's
+        # radius, where max_dist along the surface is a chord of length `chord`
+        R = 6378137
+        lats, lons = np.radians(lats), np.radians(lons)
+        points = R * np.column_stack([np.cos(lats) * np.cos(lons),
+                                      np.cos(lats) * np.sin(lons),
+                                      np.sin(lats)])
+        chord = 2 * R * np.sin(max_dist / (2 * R))
+        pairs = cKDTree(points).query_pairs(r=chord, output_type='ndarray')
+        # Order pairs by i, then j, to match the greedy merge order
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        _merge_clusters(pairs, props, durations)
+
+    return [{**clusters[i],
+             'rank': rank,
+             'proportion': float(props[i]),
+             'duration': int(durations[i])}
+            for rank, i in enumerate(np.flatnonzero(props > 0))]
+
+def _merge_clusters(pairs, props, durations):
+    """ Helper function to greedily merge close pairs of clusters into the first one
+
+        Args:
+            pairs (np.ndarray): The (i, j) indices of clusters closer than
+                max_dist, with i < j, sorted by i and then j.
+            props (np.ndarray): The cluster proportions; updated in place.
+            durations (np.ndarray): The cluster durations; updated in place.
+    """
+    for k in range(pairs.shape[0]):
+        i, j = pairs[k, 0], pairs[k, 1]
+        if props[i] > 0:
+            props[i] += props[j]
+            props[j] = 0
+            durations[i] += durations[j]
+
+def _location_durations(timestamps, clusters, num_clusters):
+    """ Helper function to get the duration spent in each location
+
+        Args:
+            timestamps (np.ndarray): The timestamps of the original GPS reads.
+            clusters (np.ndarray): The cluster index of each GPS read (-1 if
+                the read is not in a cluster).
+            num_clusters (int): The number of clusters.
+
+        Returns:
+            An np.ndarray, the duration in each cluster (in ms).
+    """
+    if len(clusters) == 0:
+        return np.zeros(num_clusters, dtype=np.int64)
+
+    # Reversed views, so no copy of the reads is made
+    timestamps = timestamps[::-1]
+    clusters = clusters[::-1]
+
+    # Split the reads into runs of consecutive reads in the same cluster and
+    # add up the time spanned by each run in its cluster
+    starts = np.flatnonzero(np.r_[True, clusters[1:] != clusters[:-1]])
+    ends = np.r_[starts[1:], len(clusters)] - 1
+    labels = clusters[starts]
+    in_cluster = (labels >= 0) & (labels < num_clusters)
+    durations = np.bincount(labels[in_cluster],
+                            weights=timestamps[ends[in_cluster]] - timestamps[starts[in_cluster]],
+                            minlength=num_clusters)
+    return durations.astype(np.int64)
+
+def _reduced_data_path(participant):
+    """ Helper function to get the local cache file of a participant's reduced gps data
+
+        Args:
+            participant (string): The participant's LAMP id.
+
+        Returns:
+            A string, the path of the cache file.
+    """
+    return os.path.join(cache_finder(None), REDUCED_DATA_KEY + '_' + participant + '.pkl')
+
+def _remember_reduced_data(participant, reduced_data):
+    """ Helper function to keep a participant's reduced gps data in memory
+
+        Args:
+            participant (string): The participant's LAMP id.
+            reduced_data (dict): The reduced gps data, with fields 'end' and 'data'.
+    """
+    _REDUCED_DATA_CACHE[participant] = reduced_data
+    _REDUCED_DATA_CACHE.move_to_end(participant)
+    if len(_REDUCED_DATA_CACHE) > _REDUCED_DATA_CACHE_SIZE:
+        _REDUCED_DATA_CACHE.popitem(last=False)
+
+def _save_reduced_data(participant, reduced_data):
+    """ Helper function to save a participant's reduced gps data to the local cache
+
+        The file is written under a unique temporary name and then renamed,
+        so that a partially written file is never read, even when several
+        processes save the same participant.
 
         Args:
-            df_cluster (pd.DataFrame): The original dataframe of GPS reads.
-            cluster (int): The cluster index (i.e. rank).
+            participant (string): The participant's LAMP id.
+            reduced_data (dict): The reduced gps data, with fields 'end' and 'data'.
+    """
+    path = _reduced_data_path(participant)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        pickle.dump(reduced_data, tmp_path, compression=None, set_default_extension=False)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+def _get_reduced_data(participant, cache=False):
+    """ Helper function to get a participant's reduced gps data
+
+        Looks in memory first, then in the local cache directory (if cache),
+        and only requests the LAMP attachment if neither has it.
+
+        Args:
+            participant (string): The participant's LAMP id.
+            cache (boolean): Whether to use the local cache directory.
 
         Returns:
-            A float, duration in that cluster (in ms).
+            A dict with the fields 'end' (int) and 'data' (list of reduced points).
     """
-    df = df[::-1].reset_index()
-    arr_ext = np.r_[False, df['cluster'] == cluster, False]
+    if participant in _REDUCED_DATA_CACHE:
+        _REDUCED_DATA_CACHE.move_to_end(participant)
+        return _REDUCED_DATA_CACHE[participant]
 
-    idx = np.flatnonzero(arr_ext[:-1] != arr_ext[1:])
-    idx_list = list(zip(idx[:-1:2], idx[1::2] - int(True)))
+    if cache and os.path.exists(_reduced_data_path(participant)):
+        reduced_data = pickle.load(_reduced_data_path(participant),
+                                   compression=None, set_default_extension=False)
+    else:
+        try:
+            reduced_data = LAMP.Type.get_attachment(participant, REDUCED_DATA_KEY)['data']
+        except:
+            reduced_data = {'end':0, 'data':[]}
+        if cache:
+            _save_reduced_data(participant, reduced_data)
 
-    hometime_list = []
-    for tup in idx_list:
-        if tup[0] == tup[1]:
-            continue
-        duration = df['timestamp'][tup[1]] - df['timestamp'][tup[0]]
+    _remember_reduced_data(participant, reduced_data)
+    return reduced_data
 
-        hometime_list.append(duration)
+def _set_reduced_data(participant, reduced_data, cache=False):
+    """ Helper function to update a participant's reduced gps data
 
-    return sum(hometime_list)
+        Args:
+            participant (string): The participant's LAMP id.
+            reduced_data (dict): The reduced gps data, with fields 'end' and 'data'.
+            cache (boolean): Whether to also save it to the local cache directory.
+    """
+    LAMP.Type.set_attachment(participant, 'me', attachment_key=REDUCED_DATA_KEY,
+                             body=reduced_data)
+    _remember_reduced_data(participant, reduced_data)
+    if cache:
+        _save_reduced_data(participant, reduced_data)
 
-def _significant_locations_kmeans(k_max=10, eps=1e-5, **kwargs):
+def _significant_locations_kmeans(k_max=10, eps=1e-5, backend='sklearn', **kwargs):
     """Function to return significant locations using kmeans
         clustering.
 
         Args:
             k_max (int): The maximum number of clusters ot use.
-            eps (float): The maximum distance separating points in the
-                same cluster.
+            eps (float): The side of the grid cells (in degrees) used to
+                reduce the gps data.
+            backend (string): 'sklearn' or 'cuml'. The KMeans implementation.
             **kwargs:
 
         Returns:
     """
-    # Get DB scan metadata fir
-    try:
-        reduced_data = LAMP.Type.get_attachment(kwargs['id'],
-                                'cortex.significant_locations.reduced')['data']
-    except:
-        reduced_data = {'end':0, 'data':[]}
+    # Get previously reduced gps data
+    reduced_data = _get_reduced_data(kwargs['id'], kwargs.get('cache', False))
 
+    # Keep the reduced points as parallel arrays; they are only converted back
+    # to a list of dicts when saved as an attachment.
     reduced_data_end = reduced_data['end']
-    new_reduced_data = reduced_data['data'].copy()
+    reduced_df = pd.DataFrame(reduced_data['data'], columns=['latitude', 'longitude', 'count'])
+    reduced_lats = reduced_df['latitude'].to_numpy(dtype=float)
+    reduced_lons = reduced_df['longitude'].to_numpy(dtype=float)
+    reduced_counts = reduced_df['count'].to_numpy(dtype=np.int64)
 
-    # update reduced data by getting new gps data and running dbscan
+    # update reduced data by getting new gps data and snapping it to a grid
     if reduced_data_end < kwargs['end']:
-        ### DBSCAN ###
+        ### GRID REDUCTION ###
         _gps = gps(**{**kwargs, 'start':reduced_data_end})['data']
         df_original = pd.DataFrame.from_dict(_gps)
         if len(df_original) == 0:
             return {'data': [], 'has_raw_data': 0}
-        df_original = df_original[df_original['timestamp'] != df_original['timestamp'].shift()]
-
-        # To prevent memory issues, limit size of db scan and perform iteratively
-        cut_df = np.split(df_original,
-                [30000 * i for i in range(math.ceil(len(df_original) / 30000))])
-        for d in cut_df:
-            if len(d) == 0:
-                continue
-
-            d.reset_index(drop=True)
-            new_reduced_data = reduced_data['data'].copy()
-            dbscan = DBSCAN(eps=eps)
-            props = dbscan.fit_predict(d[['latitude', 'longitude']].values)
-            db_points = []
-            for l in np.unique(props):
-                db_lats, db_longs = ([d.iloc[i]['latitude']
-                                      for i in range(len(d)) if props[i] == l],
-                                     [d.iloc[i]['longitude']
-                                      for i in range(len(d)) if props[i] == l])
-                # db_duration = [d.iloc[i]['timestamp'] for i in range(len(d)) if props[i] == l]
-                if l == -1:
-                    db_points += [{'latitude':db_lats[i],
-                    'longitude':db_longs[i],
-                    'count':1} for i in range(len(db_lats))]
-                else:
-                    lat_mean, long_mean = np.mean(db_lats), np.mean(db_longs)
-                    if len(reduced_data['data']) == 0:
-                        db_points += [{'latitude':lat_mean,
-                                      'longitude':long_mean,
-                                  'count':len(db_lats)}]
-
-                    else:
-                        min_dist_index = np.argmin([euclid((loc['latitude'],
-                                                            loc['longitude']),
-                                                           (lat_mean, long_mean))
-                                                    for loc in reduced_data['data']])
-                        if (euclid((reduced_data['data'][min_dist_index]['latitude'],
-                                   reduced_data['data'][min_dist_index]['longitude']),
-                              (lat_mean, long_mean)) < 20):
-                            new_reduced_data[min_dist_index]['count'] += len(db_lats)
-                        else:
-                            db_points += [{'latitude':lat_mean,
-                                          'longitude':long_mean,
-                                      'count':len(db_lats)}]
-
-            # Add new db points
-            new_reduced_data += db_points
-            reduced_data = {'end':kwargs['end'], 'data':new_reduced_data}
-
-        LAMP.Type.set_attachment(kwargs['id'], 'me',
-                    attachment_key='cortex.significant_locations.reduced',
-                    body=reduced_data)
+        df_original = df_original.drop_duplicates(subset='timestamp', keep='first')
+
+        # Hash each point to a grid cell of side eps (in degrees), packing the
+        # latitude and longitude cell indices into a single int64 key
+        lat_key = (df_original['latitude'] / eps).round().astype(np.int64).values
+        lon_key = (df_original['longitude'] / eps).round().astype(np.int64).values
+        key = (lat_key << 32) | (lon_key & 0xffffffff)
+        grouped = df_original.groupby(key).agg(
+            latitude=('latitude', 'mean'),
+            longitude=('longitude', 'mean'),
+            count=('latitude', 'size'))
+        new_lats = grouped['latitude'].values
+        new_lons = grouped['longitude'].values
+        new_counts = grouped['count'].values.astype(np.int64)
+
+        # Fold grid points close to an existing reduced point into its count.
+        # As with DBSCAN's default min_samples, cells with fewer than 5 reads
+        # are treated as noise and always added as new points.
+        if len(reduced_lats) > 0:
+            # One KD-tree query finds the nearest reduced point of every grid
+            # point. Longitudes are scaled as in euclid(), using one shared
+            # reference latitude so that all points live in the same plane.
+            cos_lat = np.cos(np.radians(np.mean(reduced_lats)))
+            tree = cKDTree(np.column_stack([reduced_lats, reduced_lons * cos_lat]))
+            _, min_dist_index = tree.query(np.column_stack([new_lats, new_lons * cos_lat]))
+            merged = ((new_counts >= 5)
+                      & (euclid((reduced_lats[min_dist_index], reduced_lons[min_dist_index]),
+                                (new_lats, new_lons)) < 20))
+            np.add.at(reduced_counts, min_dist_index[merged], new_counts[merged])
+            new_lats, new_lons, new_counts = (new_lats[~merged], new_lons[~merged],
+                                              new_counts[~merged])
+
+        # Add new grid points
+        reduced_lats = np.concatenate([reduced_lats, new_lats])
+        reduced_lons = np.concatenate([reduced_lons, new_lons])
+        reduced_counts = np.concatenate([reduced_counts, new_counts])
+
+        _set_reduced_data(kwargs['id'],
+                          {'end':kwargs['end'],
+                           'data':pd.DataFrame({'latitude':reduced_lats,
+                                                'longitude':reduced_lons,
+                                                'count':reduced_counts}).to_dict('records')},
+                          kwargs.get('cache', False))
        ### ###
 
-    # Prepare input parameters.
-    expanded_data = []
-    for point in reduced_data['data']:
-        expanded_data.extend([{'latitude':point['latitude'],
-                               'longitude':point['longitude']}
-                                for _ in range(point['count'])])
-
-    df_original = pd.DataFrame.from_dict(expanded_data)
-    df2 = df_original[['latitude', 'longitude']].values
-    k_clusters = range(1, min(k_max, len(df_original)))
-    kmeans = [KMeans(n_clusters=i) for i in k_clusters]
-
-    # Determine number of clusters to score.
+    # Prepare input parameters; each reduced point is weighted by its count.
+    df2 = np.column_stack([reduced_lats, reduced_lons])
+    weights = reduced_counts
+    k_clusters = range(1, min(k_max, len(df2)))
+
+    if backend == 'cuml' and cuKMeans is None:
+        log.warning("cuML is not installed, falling back to the sklearn backend.")
+        backend = 'sklearn'
+    # Only the relative scores matter when picking k, so a single short fit
+    # per candidate is enough.
+    elbow_args = {'n_init': 1, 'max_iter': 50, 'tol': 1e-3}
+    if backend == 'cuml':
+        kmeans_cls, elbow_cls = cuKMeans, cuKMeans
+    else:
+        kmeans_cls, elbow_cls = KMeans, MiniBatchKMeans
+        elbow_args['batch_size'] = 1024
+
+    # Determine number of clusters to score. The data is converted once so
+    # that each fit can skip its own conversion. It is centered first: the
+    # squared norms of raw coordinates (~7e3 deg^2) would swamp the
+    # within-cluster distances at float32 precision. Candidates are fit in
+    # order and we stop at the first one that barely improves the score,
+    # keeping the previous number of clusters.
     log.info('Calculating number of clusters to score with k_max=%d...', k_max)
-    score = [kmeans[i].fit(df2).score(df2) for i in range(len(kmeans))]
-    for i, val in enumerate(score):
-        if i == len(score) - 1:
-            k = i + 1
-            break
-        if abs(score[i + 1] - val < .01):
-            k = i + 1
+    elbow_data = np.ascontiguousarray(df2 - df2.mean(axis=0), dtype=np.float32)
+    elbow_weights = np.ascontiguousarray(weights, dtype=np.float32)
+    k, prev_score = 1, None
+    for i in k_clusters:
+        score = (elbow_cls(n_clusters=i, **elbow_args)
+                 .fit(elbow_data, sample_weight=elbow_weights)
+                 .score(elbow_data, sample_weight=elbow_weights))
+        if prev_score is not None and abs(score - prev_score) < .01:
             break
+        k, prev_score = i, score
 
     # Compute KMeans clusters.
     log.info('Computing KMeans++ with k=%d...', k)
-    kmeans = KMeans(n_clusters=k, init='k-means++')
-    kmeans.fit(df2)
+    kmeans = kmeans_cls(n_clusters=k)
+    kmeans.fit(df2, sample_weight=weights)
 
     # Get gps data for this window
     _gps = gps(**kwargs)['data']
@@ -281,8 +403,17 @@ def _significant_locations_kmeans(k_max=10, eps=1e-5, **kwargs):
     newdf = pd.DataFrame.from_dict(_gps)
     newdf_coords = newdf[['latitude', 'longitude']].values
     props = kmeans.predict(newdf_coords)
-    newdf.loc[:, 'cluster'] = props
-
+    timestamps = newdf['timestamp'].values
+
+    # Compute the mean distance (in m) of the points to their centroid, the
+    # number of points and the duration in each centroid in a single pass.
+    centers = kmeans.cluster_centers_
+    num_clusters = len(centers)
+    point_dists = euclid((centers[props, 0], centers[props, 1]),
+                         (newdf_coords[:, 0], newdf_coords[:, 1])) * 1000
+    counts = np.bincount(props, minlength=num_clusters)
+    dist_sums = np.bincount(props, weights=point_dists, minlength=num_clusters)
+    durations = _location_durations(timestamps, props, num_clusters)
 
     # Add proportion of GPS within each centroid and return output.
     return {'data': [{
@@ -291,16 +422,11 @@ def _significant_locations_kmeans(k_max=10, eps=1e-5, **kwargs):
         'latitude': center[0],
         'longitude': center[1],
         'rank': idx, #significant locations in terms of prevelance (0 being home)
-        'radius': np.mean(euclid(center,
-
-            # Transpose the points within the centroid and calculate the mean euclidean
-            # distance (in km) from the center-point and convert that to meters.
-            np.transpose(newdf_coords[np.argwhere(props == idx)].reshape((-1, 2)))
-        ) * 1000) if props[props == idx].size > 0 else None,
-        'proportion': props[props == idx].size / props.size,
-        # props[props == idx].size * 200 #EXPECTED duration in ms
-        'duration': _location_duration(newdf, idx)
-    } for idx, center in enumerate(kmeans.cluster_centers_)], 'has_raw_data': 1}
+        'radius': dist_sums[idx] / counts[idx] if counts[idx] > 0 else None,
+        'proportion': counts[idx] / props.size,
+        # counts[idx] * 200 #EXPECTED duration in ms
+        'duration': int(durations[idx])
+    } for idx, center in enumerate(centers)], 'has_raw_data': 1}
 
 def _significant_locations_mode(max_clusters, min_cluster_size, max_dist, **kwargs):
     """ Function to assign points to k significant locations using mode method.
@@ -321,51 +447,51 @@ def _significant_locations_mode(max_clusters, min_cluster_size, max_dist, **kwar
         return {'data': [], 'has_raw_data': 0}
 
     df_original = pd.DataFrame.from_dict(_gps)
-    df_original = df_original[df_original['timestamp'] != df_original['timestamp'].shift()]
+    df_original = df_original.drop_duplicates(subset='timestamp', keep='first')
     df_clusters = df_original.copy(deep=True)
-    ind = df_original.shape[0] * [-1]
-    df_clusters["cluster"] = ind
-    cluster_locs = []
 
-    df_clusters['latitude'] = df_clusters['latitude'].apply(lambda x: round(x, 3))
-    df_clusters['longitude'] = df_clusters['longitude'].apply(lambda x: round(x, 3))
+    df_clusters['latitude'] = np.round(df_clusters['latitude'].values, 3)
+    df_clusters['longitude'] = np.round(df_clusters['longitude'].values, 3)
     top_counts = df_clusters[['latitude', 'longitude']].value_counts()
-    top_points = top_counts.index.tolist()
 
     min_cluster_points = int(min_cluster_size * len(df_original))
 
     if max_clusters != -1:
-        for k in range(max_clusters):
-            if k < len(top_points):
-                df_clusters.loc[(df_clusters["latitude"] == top_points[k][0]) &
-                                (df_clusters["longitude"] == top_points[k][1]),
-                                'cluster'] = k
-                cluster_locs.append(top_points[k])
+        num_clusters = max(0, min(max_clusters, len(top_counts)))
     else:
-        k = 0
-        while (k < len(top_counts) and top_counts.iloc[k] > min_cluster_points
-               and k < len(df_original) - 1):
-            df_clusters.loc[(df_clusters["latitude"] == top_points[k][0]) &
-                            (df_clusters["longitude"] == top_points[k][1]),
-                            'cluster'] = k
-            cluster_locs.append(top_points[k])
-            k += 1
-
+        # top_counts is sorted, so this is the number of leading locations
+        # with more than min_cluster_points points
+        num_clusters = max(0, min(int((top_counts.values > min_cluster_points).sum()),
+                                  len(df_original) - 1))
+
+    # Label every point with the position of its location among the top
+    # locations in a single lookup, or -1 if it is not one of them
+    cluster_index = top_counts.index[:num_clusters]
+    cluster_locs = cluster_index.tolist()
+    df_clusters['cluster'] = cluster_index.get_indexer(
+        pd.MultiIndex.from_frame(df_clusters[['latitude', 'longitude']]))
+
+    # Distance (in m) from each clustered point to its center, computed with
+    # one contiguous pass over the points instead of per-cluster reshapes
+    clusters = df_clusters['cluster'].values
+    in_cluster = clusters >= 0
+    labels = clusters[in_cluster]
+    centers = np.array(cluster_locs, dtype=float).reshape((-1, 2))
+    point_dists = euclid((centers[labels, 0], centers[labels, 1]),
+                         (df_original['latitude'].values[in_cluster],
+                          df_original['longitude'].values[in_cluster])) * 1000
+    counts = np.bincount(labels, minlength=len(cluster_locs))
+    dist_sums = np.bincount(labels, weights=point_dists, minlength=len(cluster_locs))
+    durations = _location_durations(df_clusters['timestamp'].values,
+                                    clusters,
+                                    len(cluster_locs))
     return {'data': remove_clusters([{
         'start':kwargs['start'],
         'end':kwargs['end'],
         'latitude': center[0],
         'longitude': center[1],
         'rank': idx,  # significant locations in terms of prevelance (0 being home)
-        'radius': np.mean(euclid((center[1],center[0]),
-
-            # Transpose the points within the centroid and calculate the mean
-            # euclidean distance (in km) from the center-point and convert that
-            # to meters.
-            np.transpose(df_original.loc[(df_clusters['cluster'] == idx),
-                        ['longitude','latitude']].values.reshape((-1, 2)))
-        ) * 1000) if df_clusters[df_clusters['cluster'] != idx].size else None,
-        'proportion': (df_clusters[df_clusters['cluster'] == idx].size /
-                       df_clusters[df_clusters['cluster'] != -1].size),
-        'duration': _location_duration(df_clusters, idx)
+        'radius': dist_sums[idx] / counts[idx] if counts[idx] > 0 else None,
+        'proportion': counts[idx] / counts.sum(),
+        'duration': int(durations[idx])
     } for idx, center in enumerate(cluster_locs)], max_dist), 'has_raw_data': 1}
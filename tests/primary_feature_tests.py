@@ -4,6 +4,8 @@ import sys
 import os
 import math
 import logging
+from unittest import mock
+import numpy as np
 import pandas as pd
 import cortex
 import cortex.primary as primary
@@ -215,6 +217,86 @@ class TestPrimary(unittest.TestCase):
         self.assertEqual(ret[1]['longitude'], -71.105)
         self.assertEqual(len(ret), 2)
 
+    @staticmethod
+    def _synthetic_gps(centers, reads_per_center, noise, seed=0):
+        # Build gps reads around each center, newest first as returned by LAMP
+        rng = np.random.default_rng(seed)
+        reads = []
+        for lat, lon in centers:
+            for _ in range(reads_per_center):
+                reads.append({'timestamp': len(reads) * 1000,
+                              'latitude': lat + rng.normal(0, noise),
+                              'longitude': lon + rng.normal(0, noise)})
+        return {'data': reads[::-1]}
+
+    def test_siglocs_remove_clusters_merge_order(self):
+        # Clusters 0-1 and 1-2 are ~200m apart, 0-2 are ~400m apart. With
+        # max_dist=300, 1 is merged into 0 and can then no longer absorb 2.
+        clusters = [{'latitude': 42.3200 + i * 0.0018, 'longitude': -71.05,
+                     'rank': i, 'proportion': prop, 'duration': dur}
+                    for i, (prop, dur) in enumerate([(0.5, 100), (0.3, 40), (0.2, 7)])]
+        ret = primary.significant_locations.remove_clusters(clusters, 300)
+        self.assertEqual(len(ret), 2)
+        self.assertEqual([c['rank'] for c in ret], [0, 1])
+        self.assertAlmostEqual(ret[0]['proportion'], 0.8)
+        self.assertEqual(ret[0]['duration'], 140)
+        self.assertEqual(ret[1]['latitude'], clusters[2]['latitude'])
+        self.assertAlmostEqual(ret[1]['proportion'], 0.2)
+        self.assertEqual(ret[1]['duration'], 7)
+
+    def test_siglocs_remove_clusters_no_merge(self):
+        # With max_dist=0 nothing is merged; empty clusters are dropped and
+        # the remaining ones are re-ranked
+        clusters = [{'latitude': 42.32, 'longitude': -71.05, 'rank': 0,
+                     'proportion': 0.6, 'duration': 10},
+                    {'latitude': 42.32, 'longitude': -71.05, 'rank': 1,
+                     'proportion': 0, 'duration': 0},
+                    {'latitude': 42.33, 'longitude': -71.05, 'rank': 2,
+                     'proportion': 0.4, 'duration': 5}]
+        ret = primary.significant_locations.remove_clusters(clusters, 0)
+        self.assertEqual([(c['rank'], c['proportion'], c['duration']) for c in ret],
+                         [(0, 0.6, 10), (1, 0.4, 5)])
+
+    def test_siglocs_location_durations(self):
+        # Reads are newest first; reversed, cluster 0 has runs spanning 3-5
+        # and 9-10, cluster 1 spans 6-7 and cluster 2 is never visited
+        timestamps = np.array([10, 9, 8, 7, 6, 5, 4, 3])
+        clusters = np.array([0, 0, -1, 1, 1, 0, 0, 0])
+        durations = primary.significant_locations._location_durations(timestamps, clusters, 3)
+        self.assertEqual(durations.tolist(), [3, 1, 0])
+        self.assertEqual(primary.significant_locations._location_durations(
+            timestamps[:0], clusters[:0], 2).tolist(), [0, 0])
+
+    def test_siglocs_mode_radius(self):
+        # All reads fall in one location, ~16m east or west of its center
+        reads = [{'timestamp': i * 1000, 'latitude': 42.32,
+                  'longitude': -71.05 + (0.0002 if i % 2 else -0.0002)}
+                 for i in range(100)][::-1]
+        with mock.patch.object(primary.significant_locations, 'gps',
+                               return_value={'data': reads}):
+            ret = primary.significant_locations._significant_locations_mode(
+                -1, 0.01, 0, id=self.TEST_PARTICIPANT, start=0, end=self.TEST_END_TIME)
+        self.assertEqual(len(ret['data']), 1)
+        expected = 110.25 * 1000 * 0.0002 * math.cos(math.radians(42.32))
+        self.assertAlmostEqual(ret['data'][0]['radius'], expected, delta=0.01)
+        self.assertEqual(ret['data'][0]['proportion'], 1)
+        self.assertEqual(ret['data'][0]['duration'], 99000)
+
+    def test_siglocs_kmeans_elbow(self):
+        # Four locations ~1-3km apart should give four k_means clusters
+        centers = [(42.36, -71.06), (42.38, -71.06), (42.36, -71.09), (42.39, -71.10)]
+        module = primary.significant_locations
+        for seed in range(5):
+            with mock.patch.object(module, 'gps',
+                                   return_value=self._synthetic_gps(centers, 500, 1e-4, seed)), \
+                 mock.patch.object(module, '_get_reduced_data',
+                                   return_value={'end': 0, 'data': []}), \
+                 mock.patch.object(module, '_set_reduced_data'):
+                ret = module._significant_locations_kmeans(k_max=10, id=self.TEST_PARTICIPANT,
+                                                           start=0, end=self.TEST_END_TIME)
+            self.assertEqual(len(ret['data']), 4)
+            self.assertAlmostEqual(sum(c['proportion'] for c in ret['data']), 1)
+
 
     # 2. Screen active
     def test_screenactive_no_data(self):